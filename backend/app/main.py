@@ -1,9 +1,20 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
+from starlette.datastructures import FormData, UploadFile
 from pydantic import BaseModel, Field
 import os
+import time
 import base64
+import binascii
+import functools
+import hashlib
 import httpx
+import orjson
 from dotenv import load_dotenv
 
 
@@ -29,10 +40,481 @@ class GenerateResponse(BaseModel):
     images: list[GenerateImage]
 
 
+# 上游連線池設定：跨請求重用 TCP/TLS 連線
+UPSTREAM_LIMITS = httpx.Limits(
+    max_connections=100,
+    max_keepalive_connections=20,
+    keepalive_expiry=60,
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 啟動時建立共用的 AsyncClient，關閉時釋放連線
+    app.state.gemini_client = httpx.AsyncClient(
+        base_url="https://generativelanguage.googleapis.com",
+        timeout=httpx.Timeout(120),
+        limits=UPSTREAM_LIMITS,
+        headers={"Accept": "application/json"},
+        http2=True,
+    )
+    app.state.stability_client = httpx.AsyncClient(
+        base_url="https://api.stability.ai",
+        timeout=httpx.Timeout(120),
+        limits=UPSTREAM_LIMITS,
+        http2=True,
+    )
+    # 進行中的 /api/generate 請求：request_key() -> Task
+    app.state.inflight = {}
+    # /api/generate 結果快取：request_key() -> (monotonic 時間, GenerateResponse)，LRU 順序
+    app.state.response_cache = OrderedDict()
+    try:
+        yield
+    finally:
+        await app.state.gemini_client.aclose()
+        await app.state.stability_client.aclose()
+
+
+# Gemini REST 端點路徑（相對於 gemini_client 的 base_url）
+_GEMINI_MODELS_PATH = "/v1beta/models/"
+_GEMINI_IMAGE_EDIT_URL = _GEMINI_MODELS_PATH + "gemini-2.5-flash-image-preview:generateContent"
+_STABILITY_IMAGE_TO_IMAGE_URL = "/v1/generation/stable-diffusion-xl-1024-v1-0/image-to-image"
+
+
+@functools.lru_cache(maxsize=8)
+def _predict_url(model: str) -> str:
+    return f"{_GEMINI_MODELS_PATH}{model}:predict"
+
+
+# /api/generate 結果快取的最大筆數（每筆含多張 base64 圖片，保持精簡）
+GENERATE_CACHE_SIZE = 32
+# 過期快取在上游 5xx 時仍可回傳的額外秒數（超過即不再使用）
+GENERATE_STALE_GRACE = 300
+
+# /api/stylize 手動解析表單，需自行提供 OpenAPI 的 multipart 請求結構
+STYLIZE_REQUEST_BODY = {
+    "required": True,
+    "content": {
+        "multipart/form-data": {
+            "schema": {
+                "type": "object",
+                "required": ["prompt", "image"],
+                "properties": {
+                    "prompt": {
+                        "type": "string",
+                        "description": "文字提示，會與風格描述一併使用",
+                    },
+                    "number_of_images": {
+                        "type": "integer",
+                        "minimum": 1,
+                        "maximum": 4,
+                        "default": 1,
+                    },
+                    "aspect_ratio": {"type": "string"},
+                    "sample_image_size": {"type": "string"},
+                    "person_generation": {"type": "string"},
+                    "model": {"type": "string", "default": "imagen-4.0-generate-001"},
+                    "image": {"type": "string", "format": "binary"},
+                },
+            }
+        }
+    },
+}
+
+# 上傳圖片大小上限（位元組）與分塊讀取大小
+MAX_UPLOAD_BYTES = 15 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# multipart 邊界與文字欄位的額外容許量
+_FORM_OVERHEAD_BYTES = 64 * 1024
+
+# 可能存放 base64 圖片的欄位（小寫比對）
+_B64_KEYS = frozenset(
+    {
+        "imagebytes",
+        "bytesbase64",
+        "image_base64",
+        "imagebytesbase64",
+        "bytesbase64encoded",
+    }
+)
+_INLINE_DATA_KEYS = frozenset({"inline_data", "inlineData"})
+# 通用走訪的容器節點數與結果數上限
+_MAX_WALK_NODES = 10000
+_MAX_WALK_RESULTS = 16
+
+
+def collect_base64_images(root) -> list[str]:
+    # 以堆疊迭代擷取所有可能的 base64 欄位，避免遞迴與中間串列配置
+    # 走訪節點數與結果數皆有上限，並以 id() 略過重複容器，防範異常回應
+    found: list[str] = []
+    stack = [root]
+    pop = stack.pop
+    visited: set[int] = set()
+    while stack and len(visited) < _MAX_WALK_NODES and len(found) < _MAX_WALK_RESULTS:
+        obj = pop()
+        if id(obj) in visited:
+            continue
+        visited.add(id(obj))
+        if type(obj) is dict:
+            nested = []
+            for k, v in obj.items():
+                key = k.lower() if isinstance(k, str) else str(k).lower()
+                if type(v) is dict or type(v) is list:
+                    nested.append(v)
+                elif key in _B64_KEYS:
+                    # 只收可能是圖片的長字串，避免短佔位值用盡結果數上限
+                    if isinstance(v, bytes):
+                        v = base64.b64encode(v).decode("utf-8")
+                    if isinstance(v, str) and len(v) >= 128:
+                        found.append(v)
+            # 反向推入以維持原本的走訪順序
+            stack.extend(reversed(nested))
+        elif type(obj) is list:
+            stack.extend(
+                v for v in reversed(obj[:_MAX_WALK_NODES]) if type(v) is dict or type(v) is list
+            )
+    return found
+
+
+def collect_imagen_predictions(data) -> list[str]:
+    # Imagen predict 已知結構: predictions[*].bytesBase64Encoded
+    preds = data.get("predictions") if isinstance(data, dict) else None
+    if not isinstance(preds, list):
+        return []
+    return [
+        p["bytesBase64Encoded"]
+        for p in preds
+        if isinstance(p, dict) and isinstance(p.get("bytesBase64Encoded"), str)
+    ]
+
+
+def collect_gemini_inline_data(data) -> list[str]:
+    # Gemini generateContent 已知結構: candidates[*].content.parts[*].inline_data.data
+    found: list[str] = []
+    cands = data.get("candidates") if isinstance(data, dict) else None
+    if not isinstance(cands, list):
+        return found
+    for c in cands:
+        content = c.get("content") if isinstance(c, dict) else None
+        parts = content.get("parts") if isinstance(content, dict) else None
+        if not isinstance(parts, list):
+            continue
+        for part in parts:
+            if not isinstance(part, dict):
+                continue
+            d = part.get("inline_data") or part.get("inlineData")
+            b64 = d.get("data") if isinstance(d, dict) else None
+            if isinstance(b64, str) and len(b64) > 128:
+                found.append(b64)
+    return found
+
+
+def collect_b64_from_gemini(root) -> list[str]:
+    # 擷取 inline_data / inlineData 內的 base64 資料；上限同 collect_base64_images
+    found: list[str] = []
+    stack = [root]
+    pop = stack.pop
+    visited: set[int] = set()
+    while stack and len(visited) < _MAX_WALK_NODES and len(found) < _MAX_WALK_RESULTS:
+        obj = pop()
+        if id(obj) in visited:
+            continue
+        visited.add(id(obj))
+        if type(obj) is dict:
+            nested = []
+            for k, v in obj.items():
+                if type(v) is dict:
+                    if k in _INLINE_DATA_KEYS:
+                        b64 = v.get("data")
+                        if isinstance(b64, str) and len(b64) > 128:
+                            found.append(b64)
+                    nested.append(v)
+                elif type(v) is list:
+                    nested.append(v)
+            stack.extend(reversed(nested))
+        elif type(obj) is list:
+            stack.extend(
+                v for v in reversed(obj[:_MAX_WALK_NODES]) if type(v) is dict or type(v) is list
+            )
+    return found
+
+
+def _form_text(form: FormData, name: str) -> str | None:
+    # 取出表單文字欄位；同名欄位若為檔案則視為格式錯誤
+    value = form.get(name)
+    if value is None or isinstance(value, str):
+        return value
+    raise HTTPException(status_code=422, detail=f"{name} 需為文字欄位")
+
+
+class SpooledUploadReader:
+    # 包裝上傳暫存檔但不提供 fileno()：httpx 計算 multipart 長度時會呼叫 fileno()，
+    # 使 SpooledTemporaryFile 將記憶體內的小檔寫入磁碟；改以 seek/tell 取得長度
+
+    def __init__(self, file):
+        self._file = file
+
+    def read(self, size: int = -1) -> bytes:
+        return self._file.read(size)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self._file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+
+async def read_upload(image: UploadFile) -> bytearray:
+    # 分塊讀入上傳圖片，超過上限即回 413，避免一次配置整個檔案
+    await image.seek(0)
+    buf = bytearray()
+    while chunk := await image.read(UPLOAD_CHUNK_SIZE):
+        buf.extend(chunk)
+        if len(buf) > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail="上傳圖片過大")
+    # 直接回傳 bytearray，避免再複製一份；b2a_base64 可直接接受
+    return buf
+
+
+def b64encode_upload(content: bytes | bytearray) -> str:
+    # 大型上傳的 base64 編碼；由 asyncio.to_thread 呼叫以免阻塞事件迴圈
+    return binascii.b2a_base64(content, newline=False).decode("ascii")
+
+
+def _parse_imagen_response(data) -> list[str]:
+    # 先走已知的 predictions 結構，失敗再全樹搜尋可能的 base64 欄位
+    b64_list: list[str] = collect_imagen_predictions(data)
+    if not b64_list:
+        # 全樹走訪已涵蓋 predictions / generatedImages / response 等外層鍵位
+        b64_list = collect_base64_images(data)
+
+    # 去重與清洗，最多回傳 4 張
+    uniq: list[str] = []
+    seen: set[str] = set()
+    for s in b64_list:
+        if not isinstance(s, str) or len(s) < 128:  # 過短的字串排除（大多非圖片）
+            continue
+        # API 回應幾乎不含首尾空白，僅在確實存在時才複製一份去除
+        if s[0].isspace() or s[-1].isspace():
+            s = s.strip()
+        if len(s) & 3:  # base64 長度必為 4 的倍數
+            continue
+        # str 的雜湊會快取在物件上，且字串本身已保存在 uniq，直接以字串去重
+        if s in seen:
+            continue
+        seen.add(s)
+        uniq.append(s)
+        if len(uniq) == 4:
+            break
+    return uniq
+
+
+def _summarize(obj, depth=0):
+    # 回應摘要（截斷長字串與大型容器），供錯誤訊息除錯用
+    if depth > 2:
+        return "…"
+    if isinstance(obj, dict):
+        return {k: _summarize(v, depth + 1) for k, v in list(obj.items())[:10]}
+    if isinstance(obj, list):
+        return [_summarize(v, depth + 1) for v in obj[:5]]
+    if isinstance(obj, str):
+        return (obj[:200] + "…") if len(obj) > 200 else obj
+    return obj
+
+
+def request_key(req: GenerateRequest) -> str:
+    # 以排序後的請求參數計算摘要，作為去重鍵值
+    raw = orjson.dumps(req.model_dump(), option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+async def imagen_predict(
+    client: httpx.AsyncClient,
+    api_key: str,
+    model: str,
+    instance: dict,
+    number_of_images: int,
+    aspect_ratio: str | None = None,
+    sample_image_size: str | None = None,
+    person_generation: str | None = None,
+) -> GenerateResponse:
+    # Imagen predict 呼叫、錯誤處理與回應解析；generate 與 stylize 回退共用
+    payload: dict = {
+        "instances": [instance],
+        "parameters": {
+            "sampleCount": number_of_images,
+        },
+    }
+    if aspect_ratio:
+        payload["parameters"]["aspectRatio"] = aspect_ratio
+    if sample_image_size:
+        payload["parameters"]["sampleImageSize"] = sample_image_size
+    if person_generation:
+        payload["parameters"]["personGeneration"] = person_generation
+
+    headers = {
+        "x-goog-api-key": api_key,
+        "Content-Type": "application/json",
+    }
+
+    r = await client.post(
+        _predict_url(model), content=orjson.dumps(payload), headers=headers, timeout=90
+    )
+    if r.status_code != 200:
+        try:
+            detail = orjson.loads(r.content)
+        except Exception:
+            detail = r.text
+        raise HTTPException(status_code=r.status_code, detail=detail)
+
+    data = orjson.loads(r.content)
+    images = _parse_imagen_response(data)
+    if not images:
+        # 附上回應摘要以利除錯（不包含長字串）
+        raise HTTPException(
+            status_code=502,
+            detail={"message": "未取得任何圖片", "response_preview": _summarize(data)},
+        )
+    return GenerateResponse(images=[GenerateImage(image_base64=s) for s in images])
+
+
+async def imagen_generate(
+    client: httpx.AsyncClient, api_key: str, req: GenerateRequest
+) -> GenerateResponse:
+    return await imagen_predict(
+        client,
+        api_key,
+        req.model,
+        {"prompt": req.prompt},
+        req.number_of_images,
+        aspect_ratio=req.aspect_ratio,
+        sample_image_size=req.sample_image_size,
+        person_generation=req.person_generation,
+    )
+
+
+async def gemini_edit(
+    client: httpx.AsyncClient, api_key: str, prompt: str, mime_type: str, image_b64: str
+) -> GenerateResponse | None:
+    # Gemini 多模態 generateContent：圖片 + 文字；回傳 None 表示不支援，應回退
+    # 端點: v1beta/models/gemini-2.5-flash-image-preview:generateContent
+    payload = {
+        "contents": [
+            {
+                "role": "user",
+                "parts": [
+                    {
+                        "inline_data": {
+                            "mime_type": mime_type,
+                            "data": image_b64,
+                        }
+                    },
+                    {"text": prompt},
+                ],
+            }
+        ],
+        # 請求單一候選；不設定 responseMimeType（僅允許文字/結構化）
+        "generationConfig": {
+            "candidateCount": 1
+        },
+    }
+    headers = {
+        "x-goog-api-key": api_key,
+        "Content-Type": "application/json",
+    }
+    r = await client.post(_GEMINI_IMAGE_EDIT_URL, content=orjson.dumps(payload), headers=headers)
+    if r.status_code != 200:
+        try:
+            detail = orjson.loads(r.content)
+        except Exception:
+            detail = r.text
+        # 特定錯誤才回退；其他錯誤直接拋出
+        msg = str(detail)
+        unsupported = "not supported" in msg.lower() or "unsupported" in msg.lower()
+        if not unsupported:
+            raise HTTPException(status_code=r.status_code, detail=detail)
+        return None
+
+    data = orjson.loads(r.content)
+    # 專注從 candidates[].content.parts[] 收集，並備援全域遞迴
+    b64_list = collect_gemini_inline_data(data)
+    if not b64_list:
+        b64_list = collect_b64_from_gemini(data)
+    if not b64_list:
+        # 有些情況圖片可能以其他欄位返回，提供預覽協助除錯
+        raise HTTPException(status_code=502, detail={
+            "message": "未取得任何圖片 (Gemini)",
+            "response_preview": {k: type(v).__name__ for k, v in data.items()} if isinstance(data, dict) else str(type(data)),
+        })
+    return GenerateResponse(images=[GenerateImage(image_base64=b64_list[0])])
+
+
+async def stability_image_to_image(
+    client: httpx.AsyncClient,
+    api_key: str,
+    prompt: str,
+    number_of_images: int,
+    init_image: tuple,
+) -> GenerateResponse:
+    # 使用 Stability SDXL image-to-image；init_image 為 (檔名, 檔案或位元組, MIME)
+    # 端點: https://api.stability.ai/v1/generation/stable-diffusion-xl-1024-v1-0/image-to-image
+    # 回應 (application/json): { artifacts: [{ base64: "..." }, ...] }
+    # 單張時改用 image/png 直接取回圖片位元組，省去 JSON 解析
+    samples = min(max(number_of_images, 1), 4)
+    form_data = {
+        "text_prompts[0][text]": prompt,
+        "samples": str(samples),
+        # 影響輸入影像保留程度: 0~1，越高越接近輸入
+        "strength": "0.6",
+        # CFG scale 合理值 5~12
+        "cfg_scale": "7",
+        "steps": "30",
+    }
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Accept": "image/png" if samples == 1 else "application/json",
+    }
+    r = await client.post(
+        _STABILITY_IMAGE_TO_IMAGE_URL,
+        data=form_data,
+        files={"init_image": init_image},
+        headers=headers,
+    )
+    if r.status_code != 200:
+        raise HTTPException(status_code=r.status_code, detail=r.text)
+    if samples == 1 and r.headers.get("content-type", "").startswith("image/"):
+        image_b64 = base64.b64encode(r.content).decode("utf-8")
+        return GenerateResponse(images=[GenerateImage(image_base64=image_b64)])
+    data = orjson.loads(r.content)
+    artifacts = data.get("artifacts") or []
+    b64_list = [a.get("base64") for a in artifacts if isinstance(a, dict) and a.get("base64")]
+
+    if not b64_list:
+        raise HTTPException(status_code=502, detail={
+            "message": "未取得任何圖片 (Stability)",
+            "response_preview": {"keys": list(data.keys()) if isinstance(data, dict) else str(type(data))},
+        })
+
+    return GenerateResponse(images=[GenerateImage(image_base64=b) for b in b64_list[:4]])
+
+
 def create_app() -> FastAPI:
     # 載入 .env 方便本地開發
     load_dotenv()
-    app = FastAPI(title="PhotoBooth API", version="0.1.0")
+    # 回應含多張大型 base64 圖片，改用 orjson 序列化
+    app = FastAPI(
+        title="PhotoBooth API",
+        version="0.1.0",
+        lifespan=lifespan,
+        default_response_class=ORJSONResponse,
+    )
+    # 金鑰於啟動時讀取一次，請求路徑不再查詢環境變數
+    app.state.gemini_key = os.getenv("GEMINI_API_KEY")
+    app.state.stability_key = os.getenv("STABILITY_API_KEY")
+    # stylize 策略："gemini-first"（依序回退）或 "race"（Gemini 與 Stability 同時送出）
+    app.state.stylize_strategy = os.getenv("STYLIZE_STRATEGY", "gemini-first")
+    # 相同參數的 /api/generate 結果快取秒數；預設 0（停用），啟用後重複請求會取得相同圖片
+    app.state.cache_ttl = float(os.getenv("GENERATE_CACHE_TTL", "0"))
 
     # 允許本地前端
     app.add_middleware(
@@ -48,388 +530,190 @@ def create_app() -> FastAPI:
         return {"status": "ok"}
 
     @app.post("/api/generate", response_model=GenerateResponse)
-    async def generate(req: GenerateRequest):
-        api_key = os.getenv("GEMINI_API_KEY")
+    async def generate(req: GenerateRequest, request: Request):
+        api_key = request.app.state.gemini_key
         if not api_key:
             raise HTTPException(status_code=500, detail="缺少 GEMINI_API_KEY")
 
-        url = (
-            "https://generativelanguage.googleapis.com/v1beta/models/"
-            f"{req.model}:predict"
-        )
-
-        payload: dict = {
-            "instances": [{"prompt": req.prompt}],
-            "parameters": {
-                "sampleCount": req.number_of_images,
-            },
-        }
-        if req.aspect_ratio:
-            payload["parameters"]["aspectRatio"] = req.aspect_ratio
-        if req.sample_image_size:
-            payload["parameters"]["sampleImageSize"] = req.sample_image_size
-        if req.person_generation:
-            payload["parameters"]["personGeneration"] = req.person_generation
-
-        headers = {
-            "x-goog-api-key": api_key,
-            "Content-Type": "application/json",
-        }
-
-        async with httpx.AsyncClient(timeout=90) as client:
-            r = await client.post(url, json=payload, headers=headers)
-            if r.status_code != 200:
-                try:
-                    detail = r.json()
-                except Exception:
-                    detail = r.text
-                raise HTTPException(status_code=r.status_code, detail=detail)
-
-            data = r.json()
-            # 遞迴擷取所有可能的 base64 欄位
-            def collect_base64_images(obj):
-                found: list[str] = []
-                if isinstance(obj, dict):
-                    for k, v in obj.items():
-                        key = str(k).lower()
-                        if key in {
-                            "imagebytes",
-                            "bytesbase64",
-                            "image_base64",
-                            "imagebytesbase64",
-                            "bytesbase64encoded",
-                        }:
-                            if isinstance(v, bytes):
-                                found.append(base64.b64encode(v).decode("utf-8"))
-                            elif isinstance(v, str):
-                                found.append(v)
-                        # 常見巢狀結構: { image: { imageBytes: ... } }
-                        if key in {"image", "image_data"} and isinstance(v, (dict, list)):
-                            found.extend(collect_base64_images(v))
-                        # 一般遞迴
-                        if isinstance(v, (dict, list)):
-                            found.extend(collect_base64_images(v))
-                elif isinstance(obj, list):
-                    for item in obj:
-                        found.extend(collect_base64_images(item))
-                return found
-
-            # 依不同 SDK/REST 的可能外層鍵位嘗試
-            candidate_roots = [
-                data,
-                data.get("predictions") if isinstance(data, dict) else None,
-                data.get("generatedImages") if isinstance(data, dict) else None,
-                data.get("generated_images") if isinstance(data, dict) else None,
-                data.get("response") if isinstance(data, dict) else None,
-            ]
-            b64_list: list[str] = []
-            for root in candidate_roots:
-                if root is not None:
-                    b64_list.extend(collect_base64_images(root))
-
-            # 去重與清洗
-            uniq = []
-            seen = set()
-            for s in b64_list:
-                if not isinstance(s, str):
-                    continue
-                trimmed = s.strip()
-                if len(trimmed) < 128:  # 過短的字串排除（大多非圖片）
-                    continue
-                if trimmed in seen:
-                    continue
-                seen.add(trimmed)
-                uniq.append(trimmed)
-
-            generated_images = [GenerateImage(image_base64=s) for s in uniq[:4]]
-
-            if not generated_images:
-                # 附上回應摘要以利除錯（不包含長字串）
-                def summarize(obj, depth=0):
-                    if depth > 2:
-                        return "…"
-                    if isinstance(obj, dict):
-                        return {k: summarize(v, depth + 1) for k, v in list(obj.items())[:10]}
-                    if isinstance(obj, list):
-                        return [summarize(v, depth + 1) for v in obj[:5]]
-                    if isinstance(obj, str):
-                        return (obj[:200] + "…") if len(obj) > 200 else obj
-                    return obj
-
-                raise HTTPException(
-                    status_code=502,
-                    detail={
-                        "message": "未取得任何圖片",
-                        "response_preview": summarize(data),
-                    },
-                )
+        # Cache-Control: no-cache 表示要新的圖片：略過結果快取，
+        # 但仍可加入相同參數、正在進行中的上游呼叫（其結果本身就是新產生的）
+        no_cache = "no-cache" in request.headers.get("cache-control", "").lower()
+        key = request_key(req)
+        cache = request.app.state.response_cache
+        ttl = request.app.state.cache_ttl
+        entry = cache.get(key)
+        if not no_cache and entry is not None and time.monotonic() - entry[0] < ttl:
+            cache.move_to_end(key)
+            return ORJSONResponse(entry[1].model_dump(), headers={"X-Cache": "hit"})
+
+        # 相同參數的併發請求共用同一個上游呼叫
+        inflight = request.app.state.inflight
+        task = inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(
+                imagen_generate(request.app.state.gemini_client, api_key, req)
+            )
+            inflight[key] = task
+            task.add_done_callback(lambda _: inflight.pop(key, None))
+        # shield: 單一用戶端中斷連線時不取消其他等待者共用的呼叫
+        try:
+            result = await asyncio.shield(task)
+        except HTTPException as exc:
+            # 上游 5xx 時若有未超過寬限期的過期快取，仍回傳舊結果並標示 stale；
+            # no-cache 要求新圖片，不可拿舊結果充數
+            if (
+                exc.status_code >= 500
+                and not no_cache
+                and entry is not None
+                and time.monotonic() - entry[0] < ttl + GENERATE_STALE_GRACE
+            ):
+                return ORJSONResponse(entry[1].model_dump(), headers={"X-Cache": "stale"})
+            raise
+
+        if ttl > 0:
+            cache[key] = (time.monotonic(), result)
+            cache.move_to_end(key)
+            while len(cache) > GENERATE_CACHE_SIZE:
+                cache.popitem(last=False)
+        return result
+
+    @app.post(
+        "/api/stylize",
+        response_model=GenerateResponse,
+        openapi_extra={"requestBody": STYLIZE_REQUEST_BODY},
+    )
+    async def stylize(request: Request):
+        # 表單改為手動解析，才能在讀取 body 前以 Content-Length 擋下過大的請求；
+        # request.form() 仍會完整解析上傳內容，欄位驗證僅在其後進行
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit():
+            if int(content_length) > MAX_UPLOAD_BYTES + _FORM_OVERHEAD_BYTES:
+                raise HTTPException(status_code=413, detail="上傳圖片過大")
+
+        async with request.form(max_files=1, max_fields=10) as form:
+            prompt = _form_text(form, "prompt")
+            if not prompt:
+                raise HTTPException(status_code=422, detail="缺少 prompt")
+            n_str = _form_text(form, "number_of_images") or "1"
+            try:
+                number_of_images = int(n_str)
+            except ValueError:
+                raise HTTPException(status_code=422, detail="number_of_images 需為整數")
+            if not 1 <= number_of_images <= 4:
+                raise HTTPException(status_code=422, detail="number_of_images 需介於 1-4")
+            image = form.get("image")
+            if not isinstance(image, UploadFile):
+                raise HTTPException(status_code=422, detail="缺少 image 檔案")
+
+            return await stylize_upload(
+                request,
+                prompt=prompt,
+                number_of_images=number_of_images,
+                aspect_ratio=_form_text(form, "aspect_ratio"),
+                sample_image_size=_form_text(form, "sample_image_size"),
+                person_generation=_form_text(form, "person_generation"),
+                model=_form_text(form, "model") or "imagen-4.0-generate-001",
+                image=image,
+            )
 
-            return GenerateResponse(images=generated_images)
-
-    @app.post("/api/stylize", response_model=GenerateResponse)
-    async def stylize(
-        prompt: str = Form(..., description="文字提示，會與風格描述一併使用"),
-        number_of_images: int = Form(1),
-        aspect_ratio: str | None = Form(None),
-        sample_image_size: str | None = Form(None),
-        person_generation: str | None = Form(None),
-        model: str = Form("imagen-4.0-generate-001"),
-        image: UploadFile = File(...),
-    ):
-        # 讀入上傳圖片
-        content = await image.read()
-        if not content:
+    async def stylize_upload(
+        request: Request,
+        prompt: str,
+        number_of_images: int,
+        aspect_ratio: str | None,
+        sample_image_size: str | None,
+        person_generation: str | None,
+        model: str,
+        image: UploadFile,
+    ) -> GenerateResponse:
+        # 上傳圖片僅在需要 base64 時才讀入記憶體；Stability 直接串流暫存檔
+        if not image.size:
             raise HTTPException(status_code=400, detail="上傳圖片為空")
+        if image.size > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail="上傳圖片過大")
+        image_b64: str | None = None
+
+        gemini_key = request.app.state.gemini_key
+        stability_key = request.app.state.stability_key
+        filename = image.filename or "image.png"
+        mime_type = image.content_type or "image/png"
+
+        # race：同時送出 Gemini 與 Stability，採用先成功者並取消另一個
+        if gemini_key and stability_key and request.app.state.stylize_strategy == "race":
+            content = await read_upload(image)
+            image_b64 = await asyncio.to_thread(b64encode_upload, content)
+            gemini_task = asyncio.ensure_future(
+                gemini_edit(
+                    request.app.state.gemini_client, gemini_key, prompt, mime_type, image_b64
+                )
+            )
+            stability_task = asyncio.ensure_future(
+                stability_image_to_image(
+                    request.app.state.stability_client,
+                    stability_key,
+                    prompt,
+                    number_of_images,
+                    # base64 已在送出前完成，暫存檔此時可直接串流給 Stability
+                    (filename, SpooledUploadReader(image.file), mime_type),
+                )
+            )
+            pending = {gemini_task, stability_task}
+            try:
+                while pending:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        if not task.exception() and task.result() is not None:
+                            return task.result()
+            finally:
+                for task in pending:
+                    task.cancel()
+            # 兩者皆失敗：Gemini 明確錯誤優先，否則回報 Stability 錯誤
+            if gemini_task.exception():
+                raise gemini_task.exception()
+            raise stability_task.exception()
 
         # 若設定了 GEMINI_API_KEY，優先使用 Gemini 2.5 Flash Image（多模態編輯）
-        gemini_key = os.getenv("GEMINI_API_KEY")
         if gemini_key:
-            image_b64 = base64.b64encode(content).decode("utf-8")
-            # Gemini 多模態 generateContent：圖片 + 文字
-            # 端點: v1beta/models/gemini-2.5-flash-image-preview:generateContent
-            url = (
-                "https://generativelanguage.googleapis.com/v1beta/models/"
-                "gemini-2.5-flash-image-preview:generateContent"
+            content = await read_upload(image)
+            image_b64 = await asyncio.to_thread(b64encode_upload, content)
+            result = await gemini_edit(
+                request.app.state.gemini_client, gemini_key, prompt, mime_type, image_b64
             )
-            payload = {
-                "contents": [
-                    {
-                        "role": "user",
-                        "parts": [
-                            {
-                                "inline_data": {
-                                    "mime_type": image.content_type or "image/png",
-                                    "data": image_b64,
-                                }
-                            },
-                            {"text": prompt},
-                        ],
-                    }
-                ],
-                # 請求單一候選；不設定 responseMimeType（僅允許文字/結構化）
-                "generationConfig": {
-                    "candidateCount": 1
-                },
-            }
-            headers = {
-                "x-goog-api-key": gemini_key,
-                "Content-Type": "application/json",
-            }
-            async with httpx.AsyncClient(timeout=120) as client:
-                r = await client.post(url, json=payload, headers=headers)
-                if r.status_code != 200:
-                    # 若 Gemini 端不支援，將進入下方 Stability 回退
-                    try:
-                        detail = r.json()
-                    except Exception:
-                        detail = r.text
-                    # 特定錯誤才回退；其他錯誤直接拋出
-                    msg = str(detail)
-                    unsupported = "not supported" in msg.lower() or "unsupported" in msg.lower()
-                    if not unsupported:
-                        raise HTTPException(status_code=r.status_code, detail=detail)
-                    # 否則繼續回退
-                else:
-                    data = r.json()
-                    # 從 candidates -> content -> parts 取回 inline_data（base64）或 image parts
-                    def collect_b64_from_gemini(obj):
-                        found: list[str] = []
-                        if isinstance(obj, dict):
-                            for k, v in obj.items():
-                                key = str(k)
-                                # inline_data 或 inlineData
-                                if key in ("inline_data", "inlineData") and isinstance(v, dict):
-                                    b64 = v.get("data")
-                                    if isinstance(b64, str) and len(b64) > 128:
-                                        found.append(b64)
-                                if isinstance(v, (dict, list)):
-                                    found.extend(collect_b64_from_gemini(v))
-                        elif isinstance(obj, list):
-                            for it in obj:
-                                found.extend(collect_b64_from_gemini(it))
-                        return found
-
-                    # 專注從 candidates[].content.parts[] 收集，並備援全域遞迴
-                    b64_list = []
-                    cands = data.get("candidates") if isinstance(data, dict) else None
-                    if isinstance(cands, list):
-                        for c in cands:
-                            content = c.get("content") if isinstance(c, dict) else None
-                            parts = content.get("parts") if isinstance(content, dict) else None
-                            if isinstance(parts, list):
-                                b64_list.extend(collect_b64_from_gemini(parts))
-                    if not b64_list:
-                        b64_list = collect_b64_from_gemini(data)
-                    if not b64_list:
-                        # 有些情況圖片可能以其他欄位返回，提供預覽協助除錯
-                        raise HTTPException(status_code=502, detail={
-                            "message": "未取得任何圖片 (Gemini)",
-                            "response_preview": {k: type(v).__name__ for k, v in data.items()} if isinstance(data, dict) else str(type(data)),
-                        })
-                    return GenerateResponse(images=[GenerateImage(image_base64=b64_list[0])])
+            if result is not None:
+                return result
+            # 否則繼續回退
 
         # 其餘情況：若設定了 Stability API 金鑰，回退使用以圖生圖
-        stability_key = os.getenv("STABILITY_API_KEY")
         if stability_key:
-            # 使用 Stability SDXL image-to-image
-            # 端點: https://api.stability.ai/v1/generation/stable-diffusion-xl-1024-v1-0/image-to-image
-            # 回應 (application/json): { artifacts: [{ base64: "..." }, ...] }
-            form_data = {
-                "text_prompts[0][text]": prompt,
-                "samples": str(min(max(number_of_images, 1), 4)),
-                # 影響輸入影像保留程度: 0~1，越高越接近輸入
-                "strength": "0.6",
-                # CFG scale 合理值 5~12
-                "cfg_scale": "7",
-                "steps": "30",
-            }
-            headers = {
-                "Authorization": f"Bearer {stability_key}",
-                "Accept": "application/json",
-            }
-            files = {"init_image": (image.filename or "image.png", content)}
-            async with httpx.AsyncClient(timeout=120) as client:
-                r = await client.post(
-                    "https://api.stability.ai/v1/generation/stable-diffusion-xl-1024-v1-0/image-to-image",
-                    data=form_data,
-                    files=files,
-                    headers=headers,
-                )
-                if r.status_code != 200:
-                    raise HTTPException(status_code=r.status_code, detail=r.text)
-                data = r.json()
-                artifacts = data.get("artifacts") or []
-                b64_list = [a.get("base64") for a in artifacts if isinstance(a, dict) and a.get("base64")]
-
-                if not b64_list:
-                    raise HTTPException(status_code=502, detail={
-                        "message": "未取得任何圖片 (Stability)",
-                        "response_preview": {"keys": list(data.keys()) if isinstance(data, dict) else str(type(data))},
-                    })
-
-                return GenerateResponse(images=[GenerateImage(image_base64=b) for b in b64_list[:4]])
+            await image.seek(0)
+            return await stability_image_to_image(
+                request.app.state.stability_client,
+                stability_key,
+                prompt,
+                number_of_images,
+                (filename, SpooledUploadReader(image.file), mime_type),
+            )
 
         # 否則嘗試 Gemini（注意：Imagen 多數變體不支援圖片條件）
-        api_key = os.getenv("GEMINI_API_KEY")
-        if not api_key:
+        if not gemini_key:
             raise HTTPException(status_code=400, detail="模型不支援以圖生圖，且未提供 STABILITY_API_KEY 或 GEMINI_API_KEY")
 
-        image_b64 = base64.b64encode(content).decode("utf-8")
-        url = (
-            "https://generativelanguage.googleapis.com/v1beta/models/"
-            f"{model}:predict"
+        if image_b64 is None:
+            content = await read_upload(image)
+            image_b64 = await asyncio.to_thread(b64encode_upload, content)
+        return await imagen_predict(
+            request.app.state.gemini_client,
+            gemini_key,
+            model,
+            {"prompt": prompt, "image": {"bytesBase64Encoded": image_b64}},
+            number_of_images,
+            aspect_ratio=aspect_ratio,
+            sample_image_size=sample_image_size,
+            person_generation=person_generation,
         )
 
-        payload: dict = {
-            "instances": [
-                {
-                    "prompt": prompt,
-                    "image": {"bytesBase64Encoded": image_b64},
-                }
-            ],
-            "parameters": {
-                "sampleCount": number_of_images,
-            },
-        }
-        if aspect_ratio:
-            payload["parameters"]["aspectRatio"] = aspect_ratio
-        if sample_image_size:
-            payload["parameters"]["sampleImageSize"] = sample_image_size
-        if person_generation:
-            payload["parameters"]["personGeneration"] = person_generation
-
-        headers = {
-            "x-goog-api-key": api_key,
-            "Content-Type": "application/json",
-        }
-
-        async with httpx.AsyncClient(timeout=90) as client:
-            r = await client.post(url, json=payload, headers=headers)
-            if r.status_code != 200:
-                try:
-                    detail = r.json()
-                except Exception:
-                    detail = r.text
-                raise HTTPException(status_code=r.status_code, detail=detail)
-
-            data = r.json()
-
-            # 沿用上方解析邏輯
-            def collect_base64_images(obj):
-                found: list[str] = []
-                if isinstance(obj, dict):
-                    for k, v in obj.items():
-                        key = str(k).lower()
-                        if key in {
-                            "imagebytes",
-                            "bytesbase64",
-                            "image_base64",
-                            "imagebytesbase64",
-                            "bytesbase64encoded",
-                        }:
-                            if isinstance(v, bytes):
-                                found.append(base64.b64encode(v).decode("utf-8"))
-                            elif isinstance(v, str):
-                                found.append(v)
-                        if key in {"image", "image_data"} and isinstance(v, (dict, list)):
-                            found.extend(collect_base64_images(v))
-                        if isinstance(v, (dict, list)):
-                            found.extend(collect_base64_images(v))
-                elif isinstance(obj, list):
-                    for item in obj:
-                        found.extend(collect_base64_images(item))
-                return found
-
-            candidate_roots = [
-                data,
-                data.get("predictions") if isinstance(data, dict) else None,
-                data.get("generatedImages") if isinstance(data, dict) else None,
-                data.get("generated_images") if isinstance(data, dict) else None,
-                data.get("response") if isinstance(data, dict) else None,
-            ]
-            b64_list: list[str] = []
-            for root in candidate_roots:
-                if root is not None:
-                    b64_list.extend(collect_base64_images(root))
-
-        
-            uniq = []
-            seen = set()
-            for s in b64_list:
-                if not isinstance(s, str):
-                    continue
-                trimmed = s.strip()
-                if len(trimmed) < 128:
-                    continue
-                if trimmed in seen:
-                    continue
-                seen.add(trimmed)
-                uniq.append(trimmed)
-
-            generated_images = [GenerateImage(image_base64=s) for s in uniq[:4]]
-
-            if not generated_images:
-                def summarize(obj, depth=0):
-                    if depth > 2:
-                        return "…"
-                    if isinstance(obj, dict):
-                        return {k: summarize(v, depth + 1) for k, v in list(obj.items())[:10]}
-                    if isinstance(obj, list):
-                        return [summarize(v, depth + 1) for v in obj[:5]]
-                    if isinstance(obj, str):
-                        return (obj[:200] + "…") if len(obj) > 200 else obj
-                    return obj
-
-                raise HTTPException(
-                    status_code=502,
-                    detail={
-                        "message": "未取得任何圖片",
-                        "response_preview": summarize(data),
-                    },
-                )
-
-            return GenerateResponse(images=generated_images)
-
     return app
 
 
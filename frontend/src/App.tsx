@@ -540,12 +540,17 @@ function App() {
 
     try {
       // 生成新背景
-      const gen = await axios.post<GenerateResponse>("/api/generate", {
-        prompt: BG_STYLES[bgKey],
-        number_of_images: 1,
-        aspect_ratio: "3:4",
-        sample_image_size: "2K",
-      });
+      // 每次點擊都要新背景，略過後端結果快取
+      const gen = await axios.post<GenerateResponse>(
+        "/api/generate",
+        {
+          prompt: BG_STYLES[bgKey],
+          number_of_images: 1,
+          aspect_ratio: "3:4",
+          sample_image_size: "2K",
+        },
+        { headers: { "Cache-Control": "no-cache" } }
+      );
       const bgB64 = gen.data.images?.[0]?.image_base64;
       if (!bgB64) throw new Error("未取得背景圖");
       const bgUrl = `data:image/png;base64,${bgB64}`;
@@ -935,12 +940,16 @@ function App() {
       // 3) 背景生成（若有）
       let bgUrl: string | null = null;
       if (bgKey) {
-        const gen = await axios.post<GenerateResponse>("/api/generate", {
-          prompt: BG_STYLES[bgKey],
-          number_of_images: 1,
-          aspect_ratio: "3:4",
-          sample_image_size: "2K",
-        });
+        const gen = await axios.post<GenerateResponse>(
+          "/api/generate",
+          {
+            prompt: BG_STYLES[bgKey],
+            number_of_images: 1,
+            aspect_ratio: "3:4",
+            sample_image_size: "2K",
+          },
+          { headers: { "Cache-Control": "no-cache" } }
+        );
         const bgB64 = gen.data.images?.[0]?.image_base64;
         if (!bgB64) throw new Error("未取得背景圖");
         bgUrl = `data:image/png;base64,${bgB64}`;